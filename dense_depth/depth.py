@@ -1,104 +1,18 @@
 import os
 import glob
 import argparse
-import csv
 import cv2
 import numpy as np
 import re
-from PIL import Image
+from functools import partial
 
+# shared depth / point cloud helpers, kept importable from here for existing callers
+from utils.utils import read_depth_folder, depth_to_voxel, voxel_to_csv, get_transformed_points, \
+    find_closest_3d_match
+from utils import utils
 
-def read_depth_folder(path):
-    """
-    Read all the images from a folder
-
-    :param path: path to folder to read
-    :return: list of loaded grayscale images
-    """
-    files = os.listdir(path)
-    files = [os.path.join(path, file) for file in files]
-    imgs = [cv2.imread(file, cv2.IMREAD_GRAYSCALE) for file in files]
-    return imgs
-
-
-def depth_to_voxel(img, scale=1):
-    """
-    Given a depth image, convert all the points in the image to 3D points
-
-    NOTE ON SCALE:
-        The values in 3D space are not necessarily to scale. For example a car might be a meter away in
-        real life, but on the depth map it only has a value of 10. We therefore need to give it a scale
-        value to multiply this depth by to get its actual depth in 3D space. This scale value can be
-        estimated by looking at how long or wide the actual object should be, and then scaling accordingly.
-
-    :param img: ndarray representing depth values in image
-    :param scale: how far away every value is--a number to multiply the depth values by
-    :return: n x 3 ndarray, where n is the number of 3D points, and each of the 3 represents the value
-             in that dimension
-    """
-    x = np.arange(img.shape[1])
-    y = np.arange(img.shape[0])
-    xx, yy = np.meshgrid(x, y)
-
-    # convert to n x 3
-    pixels = np.stack((xx, yy, img.astype(np.int16) * scale), axis=2)
-    pixels = np.reshape(pixels, (img.shape[0] * img.shape[1], 3))
-    pixels = pixels[pixels[:, 2] != 0]  # filter out missing data
-
-    return pixels
-
-
-def voxel_to_csv(points, path):
-    """
-    Write points to csv file
-
-    :param points: n x 3 ndarray
-    :param path: path to csv file to save to
-    :return: None
-    """
-    with open(path, "w", newline="") as f:
-        writer = csv.writer(f, delimiter=",")
-        writer.writerows(points)
-
-
-def get_transformed_points(keypoints, H_matrix):
-    keypoints_3dim = np.zeros((keypoints.shape[0], keypoints.shape[1] + 1))
-    transformed_points = np.zeros(keypoints.shape)
-    # print(keypoints_3dim.shape)
-    for i in range(len(keypoints)):
-        keypoint_3dim = np.array([[keypoints[i][1], keypoints[i][0], keypoints[i][2], 1]], dtype=float)
-        # print(np.transpose(keypoint_3dim))
-        transformed_point_3dim = np.dot(H_matrix, np.transpose(keypoint_3dim))
-        # print(transformed_point_3dim)
-
-        # normalize_transformed_point = transformed_point_3dim[:4, :] / transformed_point_3dim[3, :]
-        # keypoints_3dim[i] = transformed_point_3dim
-        new_value = np.transpose(transformed_point_3dim)
-        transformed_points[i] = [new_value[0][1], new_value[0][0], new_value[0][2]]
-        # print(transformed_points)
-
-    # print(keypoints_3dim)
-    # print(transformed_points)
-    # print(keypoints)
-    return transformed_points
-
-
-def find_closest_3d_match(x0, y0, matrix_3d):
-    arry_x0_y0 = [(x0, y0) for i in range(len(matrix_3d))]
-    index = np.argmin(np.sum(((matrix_3d[:, :2] - arry_x0_y0) ** 2), axis=0))
-    return matrix_3d[index]
-
-
-def get_3d_kps(voxels, kps):
-    kps_3d = []
-    for i in kps:
-        for v in voxels:
-            if (i[1] == v[0] and i[0] == v[1]):
-                kps_3d.append(v)
-                break
-
-    return np.array(kps_3d)
-
+# keypoints in this module have always been (y, x), so keep swapping them by default
+get_3d_kps = partial(utils.get_3d_kps, swap_xy=True)
 
 # Keras / TensorFlow
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '5'
@@ -110,7 +24,15 @@ from skimage.transform import resize
 from matplotlib import pyplot as plt
 
 def load_images_sort(image_files):
+    """
+    Read images in the order given by the last number in their file names. Every file is only read once,
+    and both the depth model input and the SIFT input are made from that read.
+
+    :param image_files: list of paths to images
+    :return: (n, 480, 640, 3) ndarray of RGB images in range [0, 1], list of (240, 320) grayscale images
+    """
     loaded_images = []
+    gray_images = []
     print(image_files)
 
     filenames_in_order = ['' for x in range(len(image_files))]
@@ -120,14 +42,16 @@ def load_images_sort(image_files):
 
     print(filenames_in_order)
     for file in filenames_in_order:
+        bgr = cv2.imread(file, cv2.IMREAD_COLOR)
+        gray_images.append(cv2.resize(cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY), (320, 240)))
 
-        x = np.clip(np.asarray(Image.open( file ), dtype=float) / 255, 0, 1)
+        x = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB).astype(np.float32) * np.float32(1 / 255)
         print(x.shape)
         new_x = resize(x, (480, 640), anti_aliasing=True)
         loaded_images.append(new_x)
-    return np.stack(loaded_images, axis=0)
+    return np.stack(loaded_images, axis=0), gray_images
 
-def get_depth(model, image_set, plot=False):
+def get_depth(model, image_set, plot=False, batch_size=2):
     """
     Note This code is used to contact the depth detection model from
     https://github.com/ialhashim/DenseDepth
@@ -135,6 +59,7 @@ def get_depth(model, image_set, plot=False):
         model:
         image_set:
         plot:
+        batch_size: number of images to run through the model at once
 
     Returns: List of rgb images, list of depth images
 
@@ -151,24 +76,17 @@ def get_depth(model, image_set, plot=False):
 
 
     # Input images
-    inputs = load_images_sort(glob.glob(image_set))
+    inputs, cv2_imgs = load_images_sort(glob.glob(image_set))
     print('\nLoaded ({0}) images of size {1}.'.format(inputs.shape[0], inputs.shape[1:]))
 
     # Compute results
-    outputs = predict(model, inputs)
+    outputs = predict(model, inputs, batch_size=batch_size)
     print(len(outputs), type(outputs))
 
-    files = glob.glob(image_set)
-
-    cv2_imgs = []
-    for f in files:
-        cv2_imgs.append(cv2.resize(cv2.imread(f, cv2.IMREAD_GRAYSCALE), (320, 240)))
-
-
     # rgb and depth images
 
     if plot:
-        for i in range(len(files)):
+        for i in range(len(cv2_imgs)):
             fig, axs = plt.subplots(2)
             axs[0].imshow(cv2_imgs[i], cmap="gray")
             axs[1].imshow(outputs[i])
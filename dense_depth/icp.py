@@ -2,66 +2,15 @@ import os
 import glob
 import argparse
 import matplotlib
-import csv
 import cv2
 import numpy as np
 from skimage.feature import blob_dog, plot_matches, match_descriptors
 import open3d as o3d
 from tempfile import TemporaryFile
 import pickle
+from concurrent.futures import ThreadPoolExecutor
 
-
-def read_depth_folder(path):
-    """
-    Read all the images from a folder
-
-    :param path: path to folder to read
-    :return: list of loaded grayscale images
-    """
-    files = os.listdir(path)
-    files = [os.path.join(path, file) for file in files]
-    imgs = [cv2.imread(file, cv2.IMREAD_GRAYSCALE) for file in files]
-    return imgs
-
-
-def depth_to_voxel(img, scale=1):
-    """
-    Given a depth image, convert all the points in the image to 3D points
-
-    NOTE ON SCALE:
-        The values in 3D space are not necessarily to scale. For example a car might be a meter away in
-        real life, but on the depth map it only has a value of 10. We therefore need to give it a scale
-        value to multiply this depth by to get its actual depth in 3D space. This scale value can be
-        estimated by looking at how long or wide the actual object should be, and then scaling accordingly.
-
-    :param img: ndarray representing depth values in image
-    :param scale: how far away every value is--a number to multiply the depth values by
-    :return: n x 3 ndarray, where n is the number of 3D points, and each of the 3 represents the value
-             in that dimension
-    """
-    x = np.arange(img.shape[1])
-    y = np.arange(img.shape[0])
-    xx, yy = np.meshgrid(x, y)
-
-    # convert to n x 3
-    pixels = np.stack((xx, yy, img.astype(np.int16) * scale), axis=2)
-    pixels = np.reshape(pixels, (img.shape[0] * img.shape[1], 3))
-    pixels = pixels[pixels[:, 2] != 0]  # filter out missing data
-
-    return pixels
-
-
-def voxel_to_csv(points, path):
-    """
-    Write points to csv file
-
-    :param points: n x 3 ndarray
-    :param path: path to csv file to save to
-    :return: None
-    """
-    with open(path, "w", newline="") as f:
-        writer = csv.writer(f, delimiter=",")
-        writer.writerows(points)
+from utils.utils import depth_to_voxel, voxel_to_csv, get_3d_kps
 
 
 def mathching_skimage(img1, kp1, des1, img2, kp2, des2, plot=False):
@@ -79,28 +28,6 @@ def mathching_skimage(img1, kp1, des1, img2, kp2, des2, plot=False):
     return matches
 
 
-def get_transformed_points(keypoints, H_matrix):
-    keypoints_3dim = np.zeros((keypoints.shape[0], keypoints.shape[1] + 1))
-    transformed_points = np.zeros(keypoints.shape)
-    # print(keypoints_3dim.shape)
-    for i in range(len(keypoints)):
-        keypoint_3dim = np.array([[keypoints[i][1], keypoints[i][0], keypoints[i][2], 1]], dtype=float)
-        # print(np.transpose(keypoint_3dim))
-        transformed_point_3dim = np.dot(H_matrix, np.transpose(keypoint_3dim))
-        # print(transformed_point_3dim)
-
-        # normalize_transformed_point = transformed_point_3dim[:4, :] / transformed_point_3dim[3, :]
-        # keypoints_3dim[i] = transformed_point_3dim
-        new_value = np.transpose(transformed_point_3dim)
-        transformed_points[i] = [new_value[0][1], new_value[0][0], new_value[0][2]]
-        # print(transformed_points)
-
-    # print(keypoints_3dim)
-    # print(transformed_points)
-    # print(keypoints)
-    return transformed_points
-
-
 '''
 def get_transformed_points(keypoints, H_matrix):
     transformed_points = np.zeros(keypoints.shape)
@@ -134,29 +61,13 @@ def get_tranfromed_m(img1, img2):
     return H_matrix, bf_matches
 
 
-def find_closest_3d_match(x0, y0, matrix_3d):
-    arry_x0_y0 = [(x0, y0) for i in range(len(matrix_3d))]
-    index = np.argmin(np.sum(((matrix_3d[:, :2] - arry_x0_y0) ** 2), axis=0))
-    return matrix_3d[index]
-
-
-def get_3d_kps(voxels, kps):
-    kps_3d = []
-    for i in kps:
-        for v in voxels:
-            if (i[1] == v[0] and i[0] == v[1]):
-                kps_3d.append(v)
-                break
-
-    return np.array(kps_3d)
-
-
 # Keras / TensorFlow
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '5'
 from keras.models import load_model
 from layers import BilinearUpSampling2D
 from utils.utils import predict, load_images, display_images
 import q8, q9, fpfh
+import utils.open3d_fpfh as o3d_utils
 from matplotlib import pyplot as plt
 
 # Argument Parser
@@ -234,30 +145,38 @@ print("des size", len(des1), len(des2))
 # ransac_loop_v3(img1, img2, kp1, kp2, euclidean_matches)
 bf_matches = mathching_skimage(img1, kp1, des1, img2, kp2, des2, True)
 
-kps1_3d = get_3d_kps(input_voxels[0], kps[0])
-kps2_3d = get_3d_kps(input_voxels[1], kps[1])
+# the keypoints above are stored as (y, x)
+kps1_3d = get_3d_kps(input_voxels[0], kps[0], swap_xy=True)
+kps2_3d = get_3d_kps(input_voxels[1], kps[1], swap_xy=True)
 
-m_kps1_3d = []
-m_kps2_3d = []
+m_kps1_3d = kps1_3d[bf_matches[:, 0]]
+m_kps2_3d = kps2_3d[bf_matches[:, 1]]
 
-for m in bf_matches:
-    m_kps1_3d.append(kps1_3d[m[0]])
-    m_kps2_3d.append(kps2_3d[m[1]])
-
-retval, out, inliers = cv2.estimateAffine3D(np.array(m_kps2_3d), np.array(m_kps1_3d))
+# rigid transformation from image 2 onto image 1, robust to bad matches
+result = o3d_utils.execute_correspondence_registration(m_kps2_3d, m_kps1_3d, distance_threshold=5)
+out = result.transformation
 
 print(out)
 
-new_3d_pts = [input_voxels[0]]
-new_3d_pts.append(get_transformed_points(input_voxels[1], out))
+# Open3D applies the transformation to the whole point cloud natively
+transformed_pcd = o3d.geometry.PointCloud()
+transformed_pcd.points = o3d.utility.Vector3dVector(np.ascontiguousarray(input_voxels[1], dtype=np.float64))
+transformed_pcd.transform(out)
+
+new_3d_pts = [input_voxels[0], np.asarray(transformed_pcd.points)]
 
 pcds = []
 for i in range(len(inputs)):
     voxel_to_csv(input_voxels[i], './cars2/depth/car_{}.csv'.format(i))
     pcd = o3d.geometry.PointCloud()
-    pcd.points = o3d.utility.Vector3dVector(input_voxels[i])
+    pcd.points = o3d.utility.Vector3dVector(np.ascontiguousarray(input_voxels[i], dtype=np.float64))
     pcds.append(pcd)
-    o3d.io.write_point_cloud("./cars2/depth/car_{}.pcd".format(i), pcd)
+
+# write the non-empty point clouds as compressed binary PCDs, in parallel
+with ThreadPoolExecutor() as executor:
+    list(executor.map(lambda i: o3d.io.write_point_cloud("./cars2/depth/car_{}.pcd".format(i), pcds[i],
+                                                         write_ascii=False, compressed=True),
+                      [i for i in range(len(pcds)) if pcds[i].has_points()]))
 
 # o3d.visualization.draw_geometries([pcds[0]])
 
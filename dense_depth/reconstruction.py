@@ -1,6 +1,5 @@
 import os
 
-import csv
 import cv2
 import numpy as np
 from matplotlib import pyplot as plt
@@ -48,15 +47,21 @@ def depth_to_voxel(img, scale=1):
 
 def voxel_to_csv(points, path):
     """
-    Write points to csv file
+    Write points to csv file. Integer points are written as integers and float points with enough digits to read
+    back the exact same value.
 
     :param points: n x 3 ndarray
     :param path: path to csv file to save to
     :return: None
     """
-    with open(path, "w", newline="") as f:
-        writer = csv.writer(f, delimiter=",")
-        writer.writerows(points)
+    points = np.asarray(points)
+    if np.issubdtype(points.dtype, np.integer):
+        fmt = "%d"
+    elif points.dtype.itemsize <= 4:
+        fmt = "%.9g"
+    else:
+        fmt = "%.17g"
+    np.savetxt(path, points, delimiter=",", fmt=fmt)
 
 MIN_MATCH_COUNT = 10
 
@@ -30,7 +30,10 @@ def load_images(image_files):
     loaded_images = []
     for file in image_files:
 
-        x = np.clip(np.asarray(Image.open( file ), dtype=float) / 255, 0, 1)
+        # drop any alpha channel, uint8 / 255 is already in [0, 1] so it needs no clipping
+        x = np.asarray(Image.open( file ))
+        if x.ndim == 3: x = x[:, :, :3]
+        x = x.astype(np.float32) * np.float32(1 / 255)
         print(x.shape)
         new_x = resize(x, (480, 640), anti_aliasing=True)
         loaded_images.append(new_x)
@@ -1,4 +1,6 @@
 import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
@@ -21,7 +23,7 @@ def get_kps_decs(rgb_images):
     :param rgb_images: list of (l, w, 3) images
     :return: list of keypoints in ndarray format, list of keypoints in OpenCV format, list of SIFT descriptors
     """
-    sift = cv2.xfeatures2d.SIFT_create()
+    sift = utils.create_sift()
     np_kps_pre_img = []
     cv_kps_pre_img = []
     cv_des_pre_img = []
@@ -50,10 +52,19 @@ def make_3d_kps(point_clouds, np_kps_pre_img):
 
 
 def make_3d_kps_depth_img(depth_images, np_kps_pre_img):
+    """
+    Find 3D keypoints by reading the depth of every keypoint straight from its depth image
+
+    :param depth_images: list of (l, w) depth images
+    :param np_kps_pre_img: list of keypoints in ndarray format
+    :return: list of (k, 3) ndarrays of 3D keypoints
+    """
     kps_3d = []
 
     for i in range(len(depth_images)):
-        img_kp = [(p[0], p[1], depth_images[i][p[1], p[0]]) for p in np_kps_pre_img[i]]
+        # images without keypoints give a (0,) array, so make sure it can still be indexed as (k, 2)
+        kps = np.asarray(np_kps_pre_img[i]).reshape(-1, 2)
+        img_kp = np.column_stack((kps[:, 0], kps[:, 1], depth_images[i][kps[:, 1], kps[:, 0]]))
         kps_3d.append(img_kp)
 
     return kps_3d
@@ -66,16 +77,7 @@ def make_pcds(point_clouds):
     :param point_clouds: list of (n, 3) ndarrays, where the 3 represents the x y z of each point
     :return: generated PCDs
     """
-    pcds = []
-
-    for i in range(len(point_clouds)):
-
-        # convert from ndarray to PCD
-        pcd = o3d.geometry.PointCloud()
-        pcd.points = o3d.utility.Vector3dVector(point_clouds[i])
-        pcds.append(pcd)
-
-    return pcds
+    return [trans3d.make_pcd(point_cloud) for point_cloud in point_clouds]
 
 
 def fpfh(point_clouds, voxel_ds_size=10, fast=False, save_intermediate=False, out_folder=None, image_set_name=None,
@@ -180,6 +182,24 @@ def apply_poisson(pcd, plot=True):
     return mesh
 
 
+def save_pcds(pcds, out_folder, image_set_name):
+    """
+    Save point clouds as compressed binary PCD files. The files are written in parallel on a thread pool, and empty
+    point clouds are skipped.
+
+    :param pcds: list of point clouds, pcds[i] is saved to {out_folder}/{image_set_name}_{i}.pcd
+    :param out_folder: folder to save point clouds to
+    :param image_set_name: name root for point clouds
+    :return: None
+    """
+    def save_pcd(i):
+        o3d.io.write_point_cloud('{}/{}_{}.pcd'.format(out_folder, image_set_name, i), pcds[i],
+                                 write_ascii=False, compressed=True)
+
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(save_pcd, [i for i in range(len(pcds)) if pcds[i].has_points()]))
+
+
 def chain_transformation(pcds, transformations, save_intermediate=False, out_folder=None, image_set_name=None, poisson=True,
                          plot=True):
     """
@@ -203,25 +223,25 @@ def chain_transformation(pcds, transformations, save_intermediate=False, out_fol
         t = np.dot(transformations[i], pre_computed[-1])
         pre_computed.append(t)
 
-    combined_pcd = pcds[0]
-
-    if save_intermediate:
-        o3d.io.write_point_cloud('{}/{}_{}.pcd'.format(out_folder, image_set_name, 0), pcds[0])
-
-    # merge point clouds using transformation matrices
+    # move point clouds using transformation matrices
     for i in range(1, len(pcds)):
         pcds[i].transform(pre_computed[i - 1])
 
-        if save_intermediate:
-            o3d.io.write_point_cloud('{}/{}_{}.pcd'.format(out_folder, image_set_name, i), pcds[i])
+    # save before merging, since merging adds the other point clouds into pcds[0]
+    if save_intermediate:
+        save_pcds(pcds, out_folder, image_set_name)
 
+    # merge point clouds
+    combined_pcd = pcds[0]
+    for i in range(1, len(pcds)):
         # downsample after merging by voxel radius so point clouds aren't too large and redundant
         combined_pcd += pcds[i]
         combined_pcd = combined_pcd.voxel_down_sample(voxel_size=2)
 
     # generate surface mesh for merged point clouds
     combined_pcd.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=0.1, max_nn=30))
-    o3d.io.write_point_cloud('{}/{}_{}.pcd'.format(out_folder, image_set_name, "final"), combined_pcd)
+    o3d.io.write_point_cloud('{}/{}_{}.pcd'.format(out_folder, image_set_name, "final"), combined_pcd,
+                             write_ascii=False, compressed=True)
 
     if poisson:
         mesh = apply_poisson(combined_pcd, plot)
@@ -236,8 +256,28 @@ def chain_transformation(pcds, transformations, save_intermediate=False, out_fol
     print('saved final to {}/{}_{}_{}_mesh.ply'.format(out_folder, image_set_name, "final", name))
 
 
+def register_pairs(register_pair, num_images, plot=True):
+    """
+    Run register_pair(i) for every pair of consecutive images (i, i - 1). The pairs are independent and most of the
+    work in them happens in OpenCV and NumPy code that releases the GIL, so they are run on a thread pool. Plots can
+    only be drawn from the main thread, so the pairs are run one after the other when plotting.
+
+    :param register_pair: function taking the index i of the second image of a pair and returning the 4x4
+                          transformation matrix that maps image i onto image i - 1
+    :param num_images: number of images
+    :param plot: True to plot intermediate results when running algorithm, False otherwise
+    :return: list of (num_images - 1) transformation matrices, in pair order
+    """
+    if plot:
+        return [register_pair(i) for i in range(1, num_images)]
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return list(executor.map(register_pair, range(1, num_images)))
+
+
 def rigid3d_proc(point_clouds, rgb_images, depth_images, np_kps_pre_img, cv_kps_pre_img, cv_des_pre_img,
-                 save_intermediate=False, out_folder=None, image_set_name=None, poisson=True, plot=True):
+                 save_intermediate=False, out_folder=None, image_set_name=None, poisson=True, plot=True,
+                 ransac_dist=None):
     """
     Global point cloud registration by computing the 3D transformation matrix between pairs of point clouds and
     then further refining with ICP. See trans3d.register_imgs() for full documentation on how this process works.
@@ -254,40 +294,45 @@ def rigid3d_proc(point_clouds, rgb_images, depth_images, np_kps_pre_img, cv_kps_
     :param poisson: True to use Poisson surface reconstruction, False to use ball point surface reconstruction when
                     building the mesh
     :param plot: True to plot intermediate results when running algorithm, False otherwise
+    :param ransac_dist: None to fit the rigid transformation to all the matched 3D keypoints by least squares, or the
+                        max inlier distance to estimate it with Open3D's correspondence RANSAC instead, which is more
+                        robust to bad matches
     :return: None, images will be saved to the out_folder
         """
     pcds = make_pcds(point_clouds)
     kps_3d = make_3d_kps_depth_img(depth_images, np_kps_pre_img)
-    all_results = []
 
-    # perform global registration between every 2 consecutive images
-    for i in range(1, len(pcds)):
+    # global registration between 2 consecutive images
+    def register_pair(i):
         img1, kp1, des1 = rgb_images[i], cv_kps_pre_img[i], cv_des_pre_img[i]
         img2, kp2, des2 = rgb_images[i - 1], cv_kps_pre_img[i - 1], cv_des_pre_img[i - 1]
 
-        bf_matches = q8.mathching_skimage(img1, kp1, des1, img2, kp2, des2, plot)
-        H_matrix, matchs = q9.ransac_loop(img1, img2, kp1, kp2, bf_matches)
+        bf_matches = q8.matching_flann(img1, kp1, des1, img2, kp2, des2, plot)
+        H_matrix, matchs = q9.ransac_cv2(img1, img2, kp1, kp2, bf_matches)
 
-        m_kps1_3d = []
-        m_kps2_3d = []
+        # gather the 3D keypoints of both images for every match
+        matchs = np.asarray(matchs, dtype=int).reshape(-1, 2)
+        m_kps1_3d = kps_3d[i][matchs[:, 0]]
+        m_kps2_3d = kps_3d[i - 1][matchs[:, 1]]
 
-        for m in matchs:
-            m_kps1_3d.append(kps_3d[i][m[0]])
-            m_kps2_3d.append(kps_3d[i - 1][m[1]])
-
-        R, t = r3d.rigid_transform_3D(np.array(m_kps1_3d).T, np.array(m_kps2_3d).T)
-        Hmatrix = np.pad(R, ((0, 1), (0, 1)))
-        Hmatrix[3, 3] = 1
-        Hmatrix[0, 3] = t[0, 0]
-        Hmatrix[1, 3] = t[1, 0]
-        Hmatrix[2, 3] = t[2, 0]
-
-        print(t)
+        if ransac_dist is not None:
+            Hmatrix = o3d_utils.execute_correspondence_registration(m_kps1_3d, m_kps2_3d, ransac_dist).transformation
+        else:
+            R, t = r3d.rigid_transform_3D(m_kps1_3d.T, m_kps2_3d.T)
+            Hmatrix = np.pad(R, ((0, 1), (0, 1)))
+            Hmatrix[3, 3] = 1
+            Hmatrix[0, 3] = t[0, 0]
+            Hmatrix[1, 3] = t[1, 0]
+            Hmatrix[2, 3] = t[2, 0]
+
+            print(t)
         if plot:
             o3d_utils.visualize_transformation(pcds[i], pcds[i - 1], Hmatrix)
 
         print(Hmatrix)
-        all_results.append(Hmatrix)
+        return Hmatrix
+
+    all_results = register_pairs(register_pair, len(pcds), plot)
 
     # chain all point clouds together with computed transformation
     chain_transformation(pcds, all_results, save_intermediate, out_folder, image_set_name, poisson, plot)
@@ -313,21 +358,27 @@ def trans3d_proc(point_clouds, rgb_images, depth_images, save_intermediate=False
     :return: None, images will be saved to the out_folder
     """
     pcds = make_pcds(point_clouds)
-    all_results = []
 
-    # perform global registration between every 2 consecutive images
-    for i in range(1, len(pcds)):
+    # every image is in 2 pairs, so find its SIFT features once up front
+    _, cv_kps_pre_img, cv_des_pre_img = get_kps_decs(rgb_images)
+
+    # global registration between 2 consecutive images
+    def register_pair(i):
 
         # global registration with 3D transformation matrix and local fine registration with ICP
         _, _, h = trans3d.register_imgs(rgb_images[i], rgb_images[i - 1], depth_images[i], depth_images[i - 1],
                                         img1_pts=point_clouds[i], img2_pts=point_clouds[i - 1],
+                                        img1_features=(cv_kps_pre_img[i], cv_des_pre_img[i]),
+                                        img2_features=(cv_kps_pre_img[i - 1], cv_des_pre_img[i - 1]),
                                         filter_pts_frac=filter_pts_frac, partial_set_frac=partial_set_frac)
 
         if plot:
             o3d_utils.visualize_transformation(pcds[i], pcds[i - 1], h)
 
         print(h)
-        all_results.append(h)
+        return h
+
+    all_results = register_pairs(register_pair, len(pcds), plot)
 
     # chain all point clouds together with computed transformation
     chain_transformation(pcds, all_results, save_intermediate, out_folder, image_set_name, poisson, plot)
@@ -341,7 +392,7 @@ def depth_images_to_3d_pts(depth_images, scale=1.):
     :param scale: constant to scale depth down by
     :return: list of (l x w, 3) ndarrays
     """
-    return [utils.depth_to_voxel(img, scale) for img in depth_images]
+    return utils.depths_to_voxels(depth_images, scale)
 
 
 def depth_images_to_3d_pts_ld(depth_images):
@@ -362,6 +413,8 @@ if __name__ == "__main__":
 
     parser.add_argument('--model', default='./models/nyu.h5', type=str,
                         help='Trained Keras model file. Requires TensorFlow and Keras.')
+    parser.add_argument('--batch_size', default=2, type=int,
+                        help='Number of images to run through the depth model at once')
     parser.add_argument('--rgb', default='./image_sets/cars/*.jpg', type=str,
                         help='Input filename or folder for RGB images')
 
@@ -372,6 +425,9 @@ if __name__ == "__main__":
     parser.add_argument('--fast', action="store_true",
                         help='Enable to use fast global registration for FPFH. Do not use if not using FPFH for '
                              'mode option')
+    parser.add_argument('--ransac_dist', default=None, type=float,
+                        help='Max inlier distance to estimate the rigid3d transformations with RANSAC instead of least '
+                             'squares. Do not use if not using rigid3d for mode option.')
 
     parser.add_argument('--surface', default='poisson', type=str, choices=['poisson', 'ball_point'],
                         help='Method of generating surface mesh')
@@ -387,7 +443,7 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    rgb_images, depth_images = dd.get_depth(args.model, args.rgb)
+    rgb_images, depth_images = dd.get_depth(args.model, args.rgb, batch_size=args.batch_size)
 
     # plot generated depth images
     if args.plot:
@@ -418,7 +474,8 @@ if __name__ == "__main__":
                      out_folder=args.out_folder,
                      image_set_name=args.out_name,
                      poisson=poisson,
-                     plot=args.plot)
+                     plot=args.plot,
+                     ransac_dist=args.ransac_dist)
 
     elif args.mode == "3dhomo":
         trans3d_proc(point_clouds, rgb_images, depth_images,
@@ -22,6 +22,9 @@ if __name__ == "__main__":
     parser.add_argument('--fast', action="store_true",
                         help='Enable to use fast global registration for FPFH. Do not use if not using FPFH for '
                              'mode option')
+    parser.add_argument('--ransac_dist', default=None, type=float,
+                        help='Max inlier distance to estimate the rigid3d transformations with RANSAC instead of least '
+                             'squares. Do not use if not using rigid3d for mode option.')
 
     parser.add_argument('--surface', default='poisson', type=str, choices=['poisson', 'ball_point'],
                         help='Method of generating surface mesh')
@@ -69,7 +72,8 @@ if __name__ == "__main__":
                          out_folder=args.out_folder,
                          image_set_name=args.out_name,
                          poisson=poisson,
-                         plot=args.plot)
+                         plot=args.plot,
+                         ransac_dist=args.ransac_dist)
 
     elif args.mode == "3dhomo":
         rec.trans3d_proc(point_clouds, rgb_images, depth_images,
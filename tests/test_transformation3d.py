@@ -0,0 +1,16 @@
+import numpy as np
+
+from utils.transformation3d import constrained_least_squares, homo_rigid_transform_3d, make_homography_ls_matrix
+
+
+def test_homo_rigid_transform_3d_matches_full_least_squares():
+    rng = np.random.RandomState(0)
+    img1_kp = rng.rand(50, 3)
+    h = np.concatenate((rng.rand(3, 4), [[0, 0, 0, 1]]), axis=0)
+
+    # noisy matches, so the fit is a real least squares problem rather than an exact solve
+    img2_kp = img1_kp @ h[:3, :3].T + h[:3, 3] + 0.01 * rng.randn(50, 3)
+
+    expected = constrained_least_squares(make_homography_ls_matrix(img1_kp), img2_kp.flatten())
+
+    np.testing.assert_allclose(homo_rigid_transform_3d(img1_kp, img2_kp), expected, atol=1e-4)
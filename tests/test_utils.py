@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from utils.utils import depth_to_voxel, depths_to_voxels, find_closest_3d_match, voxel_to_csv
+
+
+def test_find_closest_3d_match_picks_closest_row():
+    # the closest point is the last row, while summing the distances over the points (axis=0) can only ever
+    # give an index of 0 or 1
+    matrix_3d = np.array([[0, 0, 5],
+                          [10, 10, 6],
+                          [20, 20, 7],
+                          [31, 29, 8]])
+
+    closest = find_closest_3d_match(30, 30, matrix_3d)
+
+    np.testing.assert_array_equal(closest, [31, 29, 8])
+
+
+def test_voxel_to_csv_keeps_full_precision(tmp_path):
+    # 16 bit depth times a scale has more than 6 digits
+    points = np.array([[639, 479, 65535 * 50], [0, 0, 1]])
+    path = tmp_path / "points.csv"
+
+    voxel_to_csv(points, path)
+
+    assert path.read_text().splitlines() == ["639,479,3276750", "0,0,1"]
+    np.testing.assert_array_equal(np.loadtxt(path, delimiter=","), points)
+
+    points = np.array([[0.1, 1 / 3, 123456.789]])
+    voxel_to_csv(points, path)
+    np.testing.assert_array_equal(np.loadtxt(path, delimiter=","), points)
+
+
+@pytest.mark.parametrize("scale", [1, 0.1])
+def test_depths_to_voxels_matches_depth_to_voxel(scale):
+    rng = np.random.RandomState(0)
+    depth_images = rng.randint(0, 256, size=(3, 24, 32)).astype(np.uint8)
+    depth_images[0][rng.rand(24, 32) < 0.5] = 0
+    depth_images[1] = 0
+    depth_images[2][rng.rand(24, 32) < 0.1] = 0
+
+    voxels = depths_to_voxels(depth_images, scale)
+
+    assert len(voxels) == len(depth_images)
+    for img, img_voxels in zip(depth_images, voxels):
+        np.testing.assert_array_equal(img_voxels, depth_to_voxel(img, scale))
+
+
+def test_depths_to_voxels_empty_stack():
+    assert depths_to_voxels(np.zeros((0, 24, 32))) == []
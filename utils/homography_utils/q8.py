@@ -105,6 +105,39 @@ def mathching_skimage(img1, kp1, des1, img2, kp2, des2, plot=False, x0=None, y0=
 
     return filtered_matches
 
+def matching_flann(img1, kp1, des1, img2, kp2, des2, plot=False, ratio=0.75):
+    """
+    approximate nearest neighbour matching using a FLANN KD-tree and Lowe's ratio test
+    :param img1: first image
+    :param kp1: keypoints for the first image
+    :param des1: descriptors for the first image
+    :param img2: second image
+    :param kp2: keypoints for the second image
+    :param des2: descriptors for the second image
+    :param plot: optional enables the function to display the matches
+    :param ratio: a match is kept if its distance is less than ratio times the distance of the second best match
+    :return: list of pairs of indices to match the keypoints from the first to second image
+    """
+    # FLANN needs contiguous float32 descriptors, passing them in that format avoids a copy inside OpenCV
+    des1 = np.ascontiguousarray(des1, dtype=np.float32)
+    des2 = np.ascontiguousarray(des2, dtype=np.float32)
+
+    # main matching step, algorithm 1 is FLANN_INDEX_KDTREE
+    flann = cv2.FlannBasedMatcher(dict(algorithm=1, trees=5), dict(checks=50))
+    knn_matches = flann.knnMatch(des1, des2, k=2)
+
+    # ratio test
+    matches = [(m[0].queryIdx, m[0].trainIdx) for m in knn_matches
+               if len(m) == 2 and m[0].distance < ratio * m[1].distance]
+    matches = np.array(matches, dtype=int).reshape(-1, 2)
+
+    if(plot):
+        orginal_points = np.array([(kp1[idx].pt[1], kp1[idx].pt[0]) for idx in range(len(kp1))], dtype=float)
+        prime_points = np.array([(kp2[idx].pt[1], kp2[idx].pt[0]) for idx in range(len(kp2))], dtype=float)
+        draw_matches(img1, img2, orginal_points, prime_points, matches, "FLANN matches")
+
+    return matches
+
 if __name__ == "__main__":
 
     # pasre args
@@ -56,17 +56,13 @@ def get_transformed_points(keypoints, H_matrix):
     :param H_matrix: homography matrix
     :return: list of transformed points
     """
-    keypoints_3dim = np.zeros((keypoints.shape[0], keypoints.shape[1] + 1))
-    transformed_points = np.zeros(keypoints.shape)
+    # swap to (x, y, 1) and transform every point with a single matrix multiplication
+    keypoints_3dim = np.ones((keypoints.shape[0], 3))
+    keypoints_3dim[:, :2] = keypoints[:, ::-1]
+    transformed_points = keypoints_3dim @ np.transpose(H_matrix)
 
-    for i in range(len(keypoints)):
-        keypoint_3dim = np.array([[keypoints[i][1], keypoints[i][0], 1]], dtype=float)
-        transformed_point_3dim = np.dot(H_matrix, np.transpose(keypoint_3dim))
-        normalize_transformed_point = transformed_point_3dim[:2, :] / transformed_point_3dim[2, :]
-        new_value = np.transpose(normalize_transformed_point)
-        transformed_points[i] = [new_value[0][1], new_value[0][0]]
-
-    return transformed_points
+    # normalize and swap back to (y, x)
+    return transformed_points[:, 1::-1] / transformed_points[:, 2:]
 
 def get_ssd(orginal_points, transformed_points, keypoints_prime):
     ssd = []
@@ -209,6 +205,41 @@ def ransac_loop(img1, img2, kp1, kp2, bf_matches, plot=False, x0=None, y0=None,
 
     return H_matrix, final_matches
 
+def ransac_cv2(img1, img2, kp1, kp2, bf_matches, plot=False, threshold=5.0):
+    """
+    run OpenCV's RANSAC to get the best homography matrix and the matches that are inliers for it
+    :param img1: first image
+    :param img2: second image
+    :param kp1: keypoints for the first image
+    :param kp2: keypoints for the second image
+    :param bf_matches: list of paris of indices that match keypoints form the first image to the second image
+    :param plot: option to plot the image
+    :param threshold: max reprojection error (in pixels) for a match to count as an inlier
+    :return: homography matrix, list of pairs of indices of the inlier matches
+    """
+    bf_matches = np.asarray(bf_matches, dtype=int).reshape(-1, 2)
+
+    # a homography needs at least 4 matches
+    if len(bf_matches) < 4:
+        return None, np.empty((0, 2), dtype=int)
+
+    src_points = np.float32([kp1[m[0]].pt for m in bf_matches]).reshape(-1, 1, 2)
+    dst_points = np.float32([kp2[m[1]].pt for m in bf_matches]).reshape(-1, 1, 2)
+    H_matrix, mask = cv2.findHomography(src_points, dst_points, cv2.RANSAC, threshold)
+
+    if H_matrix is None:
+        return None, np.empty((0, 2), dtype=int)
+
+    final_matches = bf_matches[mask.ravel() != 0]
+    print("Final accuracy: matches={} out of {}".format(len(final_matches), len(bf_matches)))
+
+    if (plot):
+        orginal_points = np.array([(kp1[idx].pt[1], kp1[idx].pt[0]) for idx in range(len(kp1))], dtype=float)
+        keypoints_prime = np.array([(kp2[idx].pt[1], kp2[idx].pt[0]) for idx in range(len(kp2))], dtype=float)
+        q8.draw_matches(img1, img2, orginal_points, keypoints_prime, final_matches, "inliers matching points")
+
+    return H_matrix, final_matches
+
 if __name__ == "__main__":
 
     # pasre args
@@ -106,3 +106,30 @@ def execute_fast_global_registration(source_down, target_down, source_fpfh,
         o3d.registration.FastGlobalRegistrationOption(
             maximum_correspondence_distance=distance_threshold))
     return result
+
+
+def execute_correspondence_registration(source_pts, target_pts, distance_threshold):
+    """
+    credit to open3d documentation:
+        - RANSAC 3D transformation estimation from known correspondences: http://www.open3d.org/docs/0.10.0/python_api/open3d.registration.registration_ransac_based_on_correspondence.html
+    Args:
+        source_pts: n x 3 ndarray of source points
+        target_pts: n x 3 ndarray of target points, target_pts[i] is the match of source_pts[i]
+        distance_threshold: max distance between a transformed source point and its target to count as an inlier
+
+    Returns: registration result, whose transformation maps the source points onto the target points
+
+    """
+    source = o3d.geometry.PointCloud()
+    source.points = o3d.utility.Vector3dVector(np.ascontiguousarray(source_pts, dtype=np.float64))
+    target = o3d.geometry.PointCloud()
+    target.points = o3d.utility.Vector3dVector(np.ascontiguousarray(target_pts, dtype=np.float64))
+
+    # point i of the source corresponds to point i of the target
+    corres = np.repeat(np.arange(len(source_pts), dtype=np.int32)[:, np.newaxis], 2, axis=1)
+
+    result = o3d.registration.registration_ransac_based_on_correspondence(
+        source, target, o3d.utility.Vector2iVector(corres), distance_threshold,
+        o3d.registration.TransformationEstimationPointToPoint(False), 3,
+        o3d.registration.RANSACConvergenceCriteria(100000, 1000))
+    return result
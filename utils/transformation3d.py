@@ -1,32 +1,34 @@
-import csv
-
 import cv2
 import numpy as np
 import open3d as o3d
 from scipy import optimize
 
-from utils.homography_utils.q9 import ransac_loop
+from utils.homography_utils.q9 import ransac_cv2
 from utils.homography_utils.q8 import draw_matches
 
 from utils.icp import icp
+from utils.utils import create_sift, depth_to_voxel
 
 
-def generate_keypoints_and_match(img1, img2):
+def generate_keypoints_and_match(img1, img2, img1_features=None, img2_features=None):
     """
     Given 2 images, generate SIFT keypoints and match
 
     :param img1:
     :param img2:
+    :param img1_features: (keypoints, descriptors) of img1, optional. If this is given, SIFT is not run on img1.
+    :param img2_features: (keypoints, descriptors) of img2, optional. If this is given, SIFT is not run on img2.
     :return: img1 keypoints, img2 keypoints, matches
     """
-    # SIFT isn't present in the newest OpenCV due to a patent, so to use it install an older version:
+    # SIFT isn't present in OpenCV 3.4.3 to 4.3 due to a patent, so to use it install either an older version:
     #       pip install -U opencv-contrib-python==3.4.0.12
+    # or OpenCV 4.4+, see create_sift()
     #
     # From https://stackoverflow.com/questions/18561910/cant-use-surf-sift-in-opencv#comment97755276_47565531
 
-    sift = cv2.xfeatures2d.SIFT_create()
-    kp1, des1 = sift.detectAndCompute(img1, mask=None)
-    kp2, des2 = sift.detectAndCompute(img2, mask=None)
+    sift = create_sift()
+    kp1, des1 = img1_features if img1_features is not None else sift.detectAndCompute(img1, mask=None)
+    kp2, des2 = img2_features if img2_features is not None else sift.detectAndCompute(img2, mask=None)
 
     matcher = cv2.BFMatcher(normType=cv2.NORM_L2, crossCheck=True)
     matches = matcher.match(des1, des2)
@@ -78,46 +80,6 @@ def get_key_points_from_matches(kp1, kp2, matches):
     return p1, p2
 
 
-def depth_to_voxel(img, scale=1.):
-    """
-    Given a depth image, convert all the points in the image to 3D points
-
-    NOTE ON SCALE:
-        The values in 3D space are not necessarily to scale. For example a car might be a meter away in
-        real life, but on the depth map it only has a value of 10. We therefore need to give it a scale
-        value to multiply this depth by to get its actual depth in 3D space. This scale value can be
-        estimated by looking at how long or wide the actual object should be, and then scaling accordingly.
-
-    :param img: ndarray representing depth values in image
-    :param scale: how far away every value is--a number to multiply the depth values by
-    :return: n x 3 ndarray, where n is the number of 3D points, and each of the 3 represents the value
-             in that dimension
-    """
-    x = np.arange(img.shape[1])
-    y = np.arange(img.shape[0])
-    xx, yy = np.meshgrid(x, y)
-
-    # convert to n x 3
-    pixels = np.stack((xx, yy, img.astype(np.int16) * scale), axis=2)
-    pixels = np.reshape(pixels, (img.shape[0] * img.shape[1], 3))
-    pixels = pixels[pixels[:, 2] != 0]  # filter out missing data
-
-    return pixels
-
-
-def voxel_to_csv(points, path):
-    """
-    Write points to csv file
-
-    :param points: n x 3 ndarray
-    :param path: path to csv file to save to
-    :return: None
-    """
-    with open(path, "w", newline="") as f:
-        writer = csv.writer(f, delimiter=",")
-        writer.writerows(points)
-
-
 def ls_array_from_xi_eq(x, y, z):
     return np.array([x, y, z, 1, 0, 0, 0, 0, 0, 0, 0, 0])
 
@@ -161,9 +123,19 @@ def solve_homography_ls_matrix(a_matrix):
 
 
 def homo_rigid_transform_3d(img1_kp, img2_kp):
-    A = make_homography_ls_matrix(img1_kp)
-    b = img2_kp.flatten()
-    return constrained_least_squares(A, b)
+    """
+    Find the 3D transformation that maps img1_kp onto img2_kp in the least squares sense
+
+    :param img1_kp: n x 3 ndarray of points
+    :param img2_kp: n x 3 ndarray of the matching points
+    :return: 4 x 4 transformation matrix
+    """
+    # each row of the 3 x 4 transformation only affects one coordinate of img2_kp, so the 3n x 12 system built by
+    # make_homography_ls_matrix() splits into 3 independent n x 4 systems, which a single lstsq call solves together
+    B = np.concatenate((img1_kp, np.ones((img1_kp.shape[0], 1))), axis=1)
+    x = np.linalg.lstsq(B, img2_kp, rcond=None)[0].T
+    x = np.concatenate((x, np.array([[0, 0, 0, 1]])), axis=0)
+    return x
 
 
 def constrained_least_squares(A, b):
@@ -189,12 +161,15 @@ def get_transformed_points(points, h):
 
 def make_pcd(point_cloud):
     """
+    Create an Open3D PCD object from a point cloud
 
-    :param point_cloud:
-    :return:
+    :param point_cloud: n x 3 ndarray of points
+    :return: generated PCD
     """
+    # Open3D can only copy the points in one go when they are a C-contiguous float64 array, anything else gets
+    # converted point by point
     pcd = o3d.geometry.PointCloud()
-    pcd.points = o3d.utility.Vector3dVector(point_cloud)
+    pcd.points = o3d.utility.Vector3dVector(np.ascontiguousarray(point_cloud, dtype=np.float64))
     return pcd
 
 
@@ -215,7 +190,7 @@ def apply_points_transformation(pts, transformation):
 
 
 def register_imgs(img1_rgb, img2_rgb, img1_depth, img2_depth, scale=1., filter_pts_frac=1., partial_set_frac=1.,
-                  img1_pts=None, img2_pts=None, plot=False):
+                  img1_pts=None, img2_pts=None, img1_features=None, img2_features=None, plot=False):
     """
     Perform global image registration given the RGB and depth of two images by
 
@@ -236,6 +211,10 @@ def register_imgs(img1_rgb, img2_rgb, img1_depth, img2_depth, scale=1., filter_p
                              value should be slightly lower.
     :param img1_pts: (h x w, 3) points, optional. If this is given, scale is not needed for image 1.
     :param img2_pts: (h x w, 3) points, optional. If this is given, scale is not needed for image 1.
+    :param img1_features: (keypoints, descriptors) of img1_rgb from SIFT, optional. If this is given, SIFT is not run
+                          on image 1.
+    :param img2_features: (keypoints, descriptors) of img2_rgb from SIFT, optional. If this is given, SIFT is not run
+                          on image 2.
     :param plot: True to draw matches, False otherwise
     :return: image 1 point cloud,
              image 2 point cloud,
@@ -248,9 +227,9 @@ def register_imgs(img1_rgb, img2_rgb, img1_depth, img2_depth, scale=1., filter_p
         img2_pts = depth_to_voxel(img2_depth, scale=scale)
 
     # find RGB matches
-    kp1, kp2, matches = generate_keypoints_and_match(img1_rgb, img2_rgb)
+    kp1, kp2, matches = generate_keypoints_and_match(img1_rgb, img2_rgb, img1_features, img2_features)
     matches = np.array([(m.queryIdx, m.trainIdx) for m in matches])
-    _, matches = ransac_loop(img1_rgb, img2_rgb, kp1, kp2, matches)
+    _, matches = ransac_cv2(img1_rgb, img2_rgb, kp1, kp2, matches)
 
     # draw matches
     if plot:
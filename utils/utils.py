@@ -1,10 +1,22 @@
-import csv
 import os
+from functools import lru_cache
 
 import cv2
 import numpy as np
 
 
+def create_sift():
+    """
+    Create a SIFT detector. SIFT is in the main OpenCV module again from OpenCV 4.4 onwards (its patent expired),
+    older versions only have it in opencv-contrib's xfeatures2d
+
+    :return: OpenCV SIFT detector
+    """
+    if hasattr(cv2, 'SIFT_create'):
+        return cv2.SIFT_create()
+    return cv2.xfeatures2d.SIFT_create()
+
+
 def read_depth_folder(path):
     """
     Read all the images from a folder
@@ -33,18 +45,61 @@ def depth_to_voxel(img, scale=1):
     :return: n x 3 ndarray, where n is the number of 3D points, and each of the 3 represents the value
              in that dimension
     """
-    x = np.arange(img.shape[1])
-    y = np.arange(img.shape[0])
-    xx, yy = np.meshgrid(x, y)
+    # find the pixels with depth, so missing data is filtered out before building any n x 3 arrays
+    depth = img.astype(np.int32)
+    ys, xs = np.nonzero(depth)
 
-    # convert to n x 3
-    pixels = np.stack((xx, yy, img.astype(np.int16) * scale), axis=2)
-    pixels = np.reshape(pixels, (img.shape[0] * img.shape[1], 3))
-    pixels = pixels[pixels[:, 2] != 0]  # filter out missing data
+    # convert to n x 3, scaling the depth straight into its column
+    pixels = np.empty((xs.size, 3), dtype=np.result_type(xs, depth, scale))
+    pixels[:, 0] = xs
+    pixels[:, 1] = ys
+    np.multiply(depth[ys, xs], scale, out=pixels[:, 2])
 
     return pixels
 
 
+def depths_to_voxels(depth_images, scale=1):
+    """
+    Convert a stack of depth images to 3D points (see depth_to_voxel()) in a single pass over the whole stack. The
+    returned point clouds are all views into one n x 3 array, so only one output array is allocated.
+
+    :param depth_images: (k, h, w) ndarray or list of depth images with the same shape
+    :param scale: how far away every value is--a number to multiply the depth values by
+    :return: list of k point clouds, each the same as depth_to_voxel() returns for that image
+    """
+    # find the pixels with depth in all the images at once
+    depth = np.asarray(depth_images).astype(np.int32)
+    if depth.shape[0] == 0:
+        return []
+    ks, ys, xs = np.nonzero(depth)
+
+    # convert to n x 3, scaling the depth straight into its column
+    pixels = np.empty((xs.size, 3), dtype=np.result_type(xs, depth, scale))
+    pixels[:, 0] = xs
+    pixels[:, 1] = ys
+    np.multiply(depth[ks, ys, xs], scale, out=pixels[:, 2])
+
+    # the points are ordered image by image, so split them by how many points each image has
+    counts = np.bincount(ks, minlength=depth.shape[0])
+    return np.split(pixels, np.cumsum(counts)[:-1])
+
+
+@lru_cache(maxsize=8)
+def _normalized_coords(size, c, f):
+    """
+    Compute (p - c) / f for every pixel coordinate p in [0, size). This only depends on the image shape and the
+    camera intrinsics, which are the same for every frame, so it is cached instead of recomputed per image
+
+    :param size: number of pixels along the axis
+    :param c: principal point along the axis
+    :param f: focal length along the axis
+    :return: read-only ndarray of length size
+    """
+    coords = (np.arange(size) - c) / f
+    coords.flags.writeable = False
+    return coords
+
+
 def depth_to_voxel_ld(img, scale=1):
     """
     Given a depth image, convert all the points in the image to 3D points
@@ -64,55 +119,107 @@ def depth_to_voxel_ld(img, scale=1):
     f_y = 525
     c_x = 319.5
     c_y = 239.5
-    x = np.arange(img.shape[1])
-    y = np.arange(img.shape[0])
-    xx, yy = np.meshgrid(x, y)
 
-    # convert to n x 3
-    pixels = np.stack(((xx - c_x) * img / f_x, (yy - c_y) * img / f_y, img.astype(np.int16) * scale), axis=2)
-    pixels = np.reshape(pixels, (img.shape[0] * img.shape[1], 3))
-    pixels = pixels[pixels[:, 2] != 0]  # filter out missing data
+    # find the pixels with depth, so missing data is filtered out before building any n x 3 arrays
+    depth = img.astype(np.int32)
+    ys, xs = np.nonzero(depth)
+    d = img[ys, xs]
+
+    # convert to n x 3, writing every column straight into the output
+    pixels = np.empty((xs.size, 3))
+    np.multiply(_normalized_coords(img.shape[1], c_x, f_x)[xs], d, out=pixels[:, 0])
+    np.multiply(_normalized_coords(img.shape[0], c_y, f_y)[ys], d, out=pixels[:, 1])
+    np.multiply(depth[ys, xs], scale, out=pixels[:, 2])
 
     return pixels
 
 
 def voxel_to_csv(points, path):
     """
-    Write points to csv file
+    Write points to csv file. Integer points are written as integers and float points with enough digits to read
+    back the exact same value.
 
     :param points: n x 3 ndarray
     :param path: path to csv file to save to
     :return: None
     """
-    with open(path, "w", newline="") as f:
-        writer = csv.writer(f, delimiter=",")
-        writer.writerows(points)
+    points = np.asarray(points)
+    if np.issubdtype(points.dtype, np.integer):
+        fmt = "%d"
+    elif points.dtype.itemsize <= 4:
+        fmt = "%.9g"
+    else:
+        fmt = "%.17g"
+    np.savetxt(path, points, delimiter=",", fmt=fmt)
+
+
+def voxel_to_npy(points, path):
+    """
+    Write points to a binary .npy file, which is much smaller and faster to write and read than a csv file
+
+    :param points: n x 3 ndarray
+    :param path: path to npy file to save to
+    :return: None
+    """
+    np.save(path, points.astype(np.float32))
 
 
 def get_transformed_points(keypoints, H_matrix):
-    transformed_points = np.zeros(keypoints.shape)
-    for i in range(len(keypoints)):
-        keypoint_3dim = np.array([[keypoints[i][1], keypoints[i][0], keypoints[i][2], 1]], dtype=float)
-        transformed_point_3dim = np.dot(H_matrix, np.transpose(keypoint_3dim))
+    """
+    Apply a transformation matrix to 3D points whose first two coordinates are stored as (y, x)
 
-        new_value = np.transpose(transformed_point_3dim)
-        transformed_points[i] = [new_value[0][1], new_value[0][0], new_value[0][2]]
+    :param keypoints: n x 3 ndarray of points
+    :param H_matrix: 3 x 4 or 4 x 4 transformation matrix
+    :return: n x 3 ndarray of transformed points, in the same coordinate order as keypoints
+    """
+    # swap to (x, y, z, 1) and transform every point with a single matrix multiplication
+    keypoints_4dim = np.ones((keypoints.shape[0], 4))
+    keypoints_4dim[:, :3] = keypoints[:, [1, 0, 2]]
+    transformed_points = keypoints_4dim @ np.transpose(H_matrix)
 
-    return transformed_points
+    return transformed_points[:, [1, 0, 2]]
 
 
 def find_closest_3d_match(x0, y0, matrix_3d):
-    arry_x0_y0 = [(x0, y0) for i in range(len(matrix_3d))]
-    index = np.argmin(np.sum(((matrix_3d[:, :2] - arry_x0_y0) ** 2), axis=0))
+    """
+    Find the 3D point closest to (x0, y0) in the first two dimensions
+
+    :param x0: first coordinate to match
+    :param y0: second coordinate to match
+    :param matrix_3d: n x 3 ndarray of points
+    :return: the row of matrix_3d closest to (x0, y0)
+    """
+    # squared distance per point (summed over the x, y columns, not over the points)
+    diff = matrix_3d[:, :2] - np.array([x0, y0])
+    index = np.argmin(np.einsum('ij,ij->i', diff, diff))
     return matrix_3d[index]
 
 
-def get_3d_kps(voxels, kps):
-    kps_3d = []
-    for i in kps:
-        for v in voxels:
-            if (i[0] == v[0] and i[1] == v[1]):
-                kps_3d.append(v)
-                break
+def get_3d_kps(voxels, kps, swap_xy=False):
+    """
+    Find the 3D point in voxels for every keypoint. Keypoints with no matching voxel are dropped.
+
+    NOTE ON AXIS ORDER:
+        Voxels are always stored as (x, y, depth), where x is the column and y is the row of the pixel. Keypoints
+        built as (kp.pt[0], kp.pt[1]) from OpenCV keypoints (eg. in reconstruct.get_kps_decs()) are also (x, y),
+        but the ones built as (kp.pt[1], kp.pt[0]) (eg. in the homography utils and dense_depth scripts) are
+        (y, x) and need swap_xy=True.
+
+    :param voxels: n x 3 ndarray, as returned by depth_to_voxel()
+    :param kps: k x 2 keypoints
+    :param swap_xy: False if the keypoints are stored as (x, y), True if they are stored as (y, x)
+    :return: m x 3 ndarray of the voxels matching the keypoints, where m <= k
+    """
+    # map each (x, y) pixel to its first row in voxels so every keypoint is a single dict lookup
+    voxel_index = {}
+    for i, v in enumerate(voxels[:, :2].tolist()):
+        voxel_index.setdefault(tuple(v), i)
+
+    kps = np.asarray(kps).reshape(-1, 2)
+    if swap_xy:
+        kps = kps[:, ::-1]
+
+    rows = [voxel_index.get(tuple(k)) for k in kps.tolist()]
+    rows = [r for r in rows if r is not None]
 
-    return np.array(kps_3d)
+    return voxels[np.array(rows, dtype=int)]